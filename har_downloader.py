@@ -1,21 +1,65 @@
 import argparse
+import base64
+import json
 import os
 import re
-import urllib.request
 import subprocess
 import shutil
 import sys
+import tempfile
 
 import ffmpeg
+import google_crc32c
+import ijson
+import requests
 
-from typing import List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from typing import Dict, Iterable, List, Optional, Tuple
 from tqdm import tqdm
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
 
 """
 https://www.reddit.com/r/YouShouldKnow/comments/296efo/ysk_how_to_download_any_videos_from_any_website/
 """
 
+N_DOWNLOAD_WORKERS = 16
+FRAGMENT_EXTENSIONS = (".ts", ".aac")
+LAST_NUMBER_RE = re.compile(r"(\d+)(?!.*\d)")
+PIPE_BUFFER_SIZE = 1 << 22
+KERNEL_PIPE_SIZE = 1 << 20
+CHECKSUM_MANIFEST = "checksums.json"
+FFMPEG = shutil.which("ffmpeg") or "ffmpeg"
+SCRATCH_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+@dataclass(frozen=True)
+class Paths:
+    """"""
+    root: str
+    name: str
+    fragment_dir: str
+    video: str
+
+    @classmethod
+    def from_output(cls, output_path: str) -> "Paths":
+        """"""
+        root = os.path.abspath(output_path)
+        name = os.path.basename(root)
+        return cls(root=root, name=name, fragment_dir=os.path.join(root, "fragments"),
+                   video=os.path.join(root, f"{name}.mp4"))
+
+    def fragment(self, number: int, extension: str) -> str:
+        """"""
+        return os.path.join(self.fragment_dir, f"{self.name}_{number}.{extension}")
+
+
 def safe_user_choice(prompt: str, *options: tuple) -> str:
     """"""
     attempt_counter = 0
@@ -30,122 +74,239 @@ def safe_user_choice(prompt: str, *options: tuple) -> str:
     assert False, "Too many invalid choices. Please rerun program\n"
 
 
-def safe_makedirs(dir_path: str):
+def grow_pipe(pipe) -> None:
     """"""
-    if not os.path.exists(dir_path):
-        os.makedirs(dir_path)
+    if fcntl is None or not hasattr(fcntl, "F_SETPIPE_SZ"):
+        return
+    try:
+        fcntl.fcntl(pipe, fcntl.F_SETPIPE_SZ, KERNEL_PIPE_SIZE)
+    except OSError:
+        pass  # Above /proc/sys/fs/pipe-max-size, keep the default capacity.
 
 
-def har_line_filter(line: str) -> bool:
+def get_video_links_from_har(har_file: str) -> list:
     """"""
-    return (".mp4" in line or ".ts" in line or ".aac" in line) and "value" not in line
+    with open(har_file, 'rb') as file:
+        # Targeting the URL avoids building a dict per entry; ijson still decodes every string it tokenizes.
+        urls = list(ijson.items(file, "log.entries.item.request.url", buf_size=1 << 20))
+    return [url for url in urls if url.endswith(FRAGMENT_EXTENSIONS)]
 
 
-def get_video_links_from_har(har_file: str) -> list:
+def file_checksum(path: str) -> int:
     """"""
-    with open(har_file, 'r', encoding="utf8") as file:
-        har_file = file.read()
+    with open(path, 'rb') as file:
+        return google_crc32c.value(file.read())
+
 
-    har_file = har_file.split("\n")
-    video_links = [line.split('"')[3] for line in har_file if har_line_filter(line)]
-    return [link for link in video_links if link.endswith(".ts") or link.endswith(".aac")]
+def server_checksum(headers) -> Optional[int]:
+    """"""
+    for header in ("x-goog-hash", "Digest"):
+        for item in headers.get(header, "").split(","):
+            algorithm, _, encoded = item.strip().partition("=")
+            if algorithm.lower() == "crc32c":
+                return int.from_bytes(base64.b64decode(encoded), "big")
+    return None
 
 
-def download_video_fragments(video_links: str, output_path: str) -> Tuple[List[str], List[str]]:
+def load_checksums(fragment_dir_path: str) -> Dict[str, int]:
     """"""
+    manifest_path = os.path.join(fragment_dir_path, CHECKSUM_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as file:
+        return json.load(file)
 
-    fragment_dir_path = os.path.join(output_path, "fragments")
-    output_name = os.path.basename(output_path)
 
-    safe_makedirs(output_path)
-    safe_makedirs(fragment_dir_path)
-    file_path_i = os.path.join(output_path, "fragments", f"{output_name}_{{number}}.{{extension}}")
+def save_checksums(fragment_dir_path: str, checksums: Dict[str, int]) -> None:
+    """"""
+    with open(os.path.join(fragment_dir_path, CHECKSUM_MANIFEST), 'w') as file:
+        json.dump(checksums, file)
 
-    video_file_paths, audio_file_paths = [], []
-    for video_link in tqdm(video_links, desc="Downloading video fragments", unit=" videos"):
-        number = ("0000000" + re.findall(r'\d+', video_link)[-1])[-5:]
-        extension = video_link.split(".")[-1]
-        out_path = file_path_i.format(number=number, extension=extension)
 
-        if os.path.exists(out_path) and (out_path in video_file_paths or out_path in audio_file_paths):
-            os.remove(out_path)
+def make_session(n_workers: int) -> requests.Session:
+    """"""
+    session = requests.Session()
+    # One keep-alive connection per worker, reused across fragments instead of a new TCP+TLS handshake each.
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=n_workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def fetch_fragment(session: requests.Session, video_link: str, out_path: str) -> Optional[int]:
+    """"""
+    part_path = out_path + ".part"
+    try:
+        offset = os.path.getsize(part_path)
+    except FileNotFoundError:
+        offset = 0
+
+    with session.get(video_link, headers={"Range": f"bytes={offset}-"}, stream=True) as response:
+        if response.status_code == 416 and offset > 0:
+            # Range starts at the end of the file: the previous run finished the body but not the rename.
+            os.rename(part_path, out_path)
+            return None
+        response.raise_for_status()
+
+        mode = "ab" if response.status_code == 206 else "wb"
+        with open(part_path, mode) as file:
+            for chunk in response.iter_content(1 << 20):
+                file.write(chunk)
+
+    os.rename(part_path, out_path)
+    return server_checksum(response.headers)
+
+
+def download_fragment(session: requests.Session, video_link: str, out_path: str, already_exists: bool,
+                      known_checksum: Optional[int] = None) -> Tuple[str, int]:
+    """"""
+    if already_exists:
+        checksum = file_checksum(out_path)
+        if known_checksum is None or checksum == known_checksum:
+            return out_path, checksum
+        print("CORRUPTED: ", out_path)
+        os.remove(out_path)
+
+    for _ in range(2):
+        expected_checksum = fetch_fragment(session, video_link, out_path)
+        checksum = file_checksum(out_path)
+        if expected_checksum is None or checksum == expected_checksum:
+            return out_path, checksum
+        os.remove(out_path)
+
+    raise ValueError(f"{out_path} failed its CRC32C check twice.")
+
+
+def plan_video_fragments(video_links: str, paths: Paths) -> Tuple[List[str], List[str], List[Tuple[str, str]]]:
+    """"""
+    os.makedirs(paths.fragment_dir, exist_ok=True)
 
-        if not os.path.exists(out_path):
-            urllib.request.urlretrieve(video_link, out_path)
+    fragments = []
+    for video_link in video_links:
+        number = int(LAST_NUMBER_RE.search(video_link).group(1))
+        fragments.append((number, video_link))
 
-        if out_path in audio_file_paths or out_path in video_file_paths:
-            if int(number) > 5 or len(video_links) < 20:
+    # Sorting on the parsed integer keeps concat order right without zero-padded file names,
+    # and queues the earliest fragments first so the piped mux can start on them.
+    fragments.sort(key=lambda fragment: fragment[0])
+
+    video_file_paths, audio_file_paths = [], []
+    seen_paths = set()
+    download_jobs = []
+    for number, video_link in fragments:
+        extension = video_link.split(".")[-1]
+        out_path = paths.fragment(number, extension)
+
+        if out_path in seen_paths:
+            if number > 5 or len(video_links) < 20:
                 print("DUPLICATE: ", out_path)
             continue
+        seen_paths.add(out_path)
 
         if extension == "aac":
             audio_file_paths.append(out_path)
         else:
             video_file_paths.append(out_path)
+        download_jobs.append((video_link, out_path))
 
-    return audio_file_paths, video_file_paths
+    return audio_file_paths, video_file_paths, download_jobs
 
 
-def integrated_audio_concat(output_path: str, video_file_paths: list, video_path: Optional[str] = None) -> None:
+def integrated_audio_concat(paths: Paths, video_file_paths: Iterable[str]) -> None:
     """"""
-
-    file_list_path = f"{output_path}/files.txt"
-    with open(file_list_path, 'w') as file:
+    # MPEG-TS can be concatenated byte-wise, so fragments are streamed straight into ffmpeg's stdin.
+    command = [FFMPEG, "-hide_banner", "-loglevel", "error", "-f", "mpegts", "-i", "pipe:0",
+               "-c", "copy", "-movflags", "+faststart", paths.video]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, bufsize=PIPE_BUFFER_SIZE)
+    grow_pipe(process.stdin)
+    try:
         for path in video_file_paths:
-            path = "\\".join(path.split('\\')[1:])
-            file.write(f"file '{path}'\n")
-            # break
-
-    if not video_path:
-        output_name = os.path.basename(output_path)
-        video_path = f"{output_path}/{output_name}.mp4"
-
-    subprocess.call(f"ffmpeg -safe 0 -hide_banner -loglevel error -f concat -i {file_list_path} -c copy {video_path}")
-    return video_path
+            with open(path, 'rb') as file:
+                shutil.copyfileobj(file, process.stdin, 1 << 20)
+        process.stdin.close()
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+    except BaseException:
+        process.kill()
+        process.wait()
+        # Don't leave a truncated mp4 behind for the next run's overwrite prompt.
+        if os.path.exists(paths.video):
+            os.remove(paths.video)
+        raise
+
+
+def write_concat_list(list_path: str, file_paths: List[str]) -> None:
+    """"""
+    escaped_paths = (os.path.abspath(path).replace("'", "'\\''") for path in file_paths)
+    with open(list_path, 'w') as file:
+        file.write("".join(f"file '{path}'\n" for path in escaped_paths))
 
 
-def separate_audio_concat(output_path: str, video_file_paths: list, audio_file_paths: list) -> None:
+def separate_audio_concat(paths: Paths, video_file_paths: list, audio_file_paths: list) -> None:
     """"""
     n_audio, n_video = len(video_file_paths), len(audio_file_paths)
     assert n_audio == n_video, f"number of audio ({n_audio}) and video ({n_video}) files is different."
 
-    temp_dir_path = os.path.join(output_path, "temp")
-    safe_makedirs(temp_dir_path)
-    pbar = tqdm(zip(audio_file_paths, video_file_paths), total=n_audio,
-                desc="concatenating fragments", unit="fragment")
-
-    mp4_fragment_paths = []
-    for audio_file, video_file in pbar:
-        temp_fragment_path = audio_file.replace(".aac", ".mp4").replace("fragments", "temp")
-        command = f"ffmpeg -i {video_file} -i {audio_file} -hide_banner -loglevel error "
-        command += f" -map 0:V:0 -map 1:a:0 -c copy -f mp4 -movflags +faststart {temp_fragment_path}"
-        subprocess.call(command)
-        mp4_fragment_paths.append(temp_fragment_path)
-
-    output_name = os.path.basename(output_path)
-    video_path = os.path.join(output_path, f"{output_name}.mp4")
-    integrated_audio_concat(output_path, mp4_fragment_paths, video_path=video_path)
+    with tempfile.TemporaryDirectory(prefix="har_lists_", dir=SCRATCH_DIR) as list_dir_path:
+        video_list_path = os.path.join(list_dir_path, "video_list.txt")
+        audio_list_path = os.path.join(list_dir_path, "audio_list.txt")
+        write_concat_list(video_list_path, video_file_paths)
+        write_concat_list(audio_list_path, audio_file_paths)
 
-    shutil.rmtree(temp_dir_path)
-    return video_path
+        # A single ffmpeg process concatenates both streams and muxes them in one pass.
+        command = [FFMPEG, "-hide_banner", "-loglevel", "error",
+                   "-f", "concat", "-safe", "0", "-i", video_list_path,
+                   "-f", "concat", "-safe", "0", "-i", audio_list_path,
+                   "-map", "0:V:0", "-map", "1:a:0", "-c", "copy", "-movflags", "+faststart", paths.video]
+        subprocess.run(command, check=True)
 
 
-def fragment_concat(output_path: str, video_file_paths: List[str], audio_file_paths: List[str]):
+def download_and_mux(video_links: List[str], paths: Paths, n_workers: int = N_DOWNLOAD_WORKERS) -> None:
     """"""
-    if len(audio_file_paths) == 0:
-        video_path = integrated_audio_concat(output_path, video_file_paths)
-    else:
-        video_path = separate_audio_concat(output_path, video_file_paths, audio_file_paths)
-
-
-    video_size = os.path.getsize(video_path)
+    audio_file_paths, video_file_paths, download_jobs = plan_video_fragments(video_links, paths)
+    known_checksums = load_checksums(paths.fragment_dir)
+    # One directory listing instead of a stat per fragment when deciding what is already on disk.
+    existing_names = {entry.name for entry in os.scandir(paths.fragment_dir)}
+
+    pbar = tqdm(total=len(download_jobs), desc="Downloading video fragments", unit=" videos",
+                mininterval=0.5, miniters=max(1, len(download_jobs) // 200))
+    futures = {}
+    executor = ThreadPoolExecutor(max_workers=n_workers)
+    try:
+        with pbar, make_session(n_workers) as session:
+            for video_link, out_path in download_jobs:
+                out_name = os.path.basename(out_path)
+                futures[out_path] = executor.submit(download_fragment, session, video_link, out_path,
+                                                    out_name in existing_names, known_checksums.get(out_name))
+                futures[out_path].add_done_callback(lambda _: pbar.update())
+
+            if audio_file_paths:
+                for future in futures.values():
+                    future.result()
+                separate_audio_concat(paths, video_file_paths, audio_file_paths)
+            else:
+                # ffmpeg consumes each fragment as soon as it and every fragment before it have arrived.
+                ready_paths = (futures[path].result()[0] for path in video_file_paths)
+                integrated_audio_concat(paths, ready_paths)
+    finally:
+        # On an error or Ctrl-C, drop the queued downloads instead of finishing them before the error surfaces.
+        executor.shutdown(wait=False, cancel_futures=True)
+        # Record every verified fragment, even if the mux failed, so a rerun can trust them.
+        for future in futures.values():
+            if future.done() and not future.cancelled() and future.exception() is None:
+                out_path, checksum = future.result()
+                known_checksums[os.path.basename(out_path)] = checksum
+        save_checksums(paths.fragment_dir, known_checksums)
+
+
+def clean_up_fragments(paths: Paths) -> None:
+    """"""
+    video_size = os.path.getsize(paths.video)
     if video_size < 10_000:
-        print("Video is {video_size:,}B, this is low. Please manually check to see if video correctly concatenated.")
+        print(f"Video is {video_size:,}B, this is low. Please manually check to see if video correctly concatenated.")
         return
 
-    os.remove(os.path.join(output_path, "files.txt"))
-    shutil.rmtree(os.path.join(output_path, "fragments"))
-
+    shutil.rmtree(paths.fragment_dir)
 
 
 def get_inputs():
@@ -154,36 +315,37 @@ def get_inputs():
     parser.add_argument('--har', dest='har_path', action='store', help="path to .har file", required=True)
     parser.add_argument('--output', dest='output', action='store', default="",
                         help="output name")
+    parser.add_argument('--workers', dest='n_workers', action='store', type=int, default=N_DOWNLOAD_WORKERS,
+                        help="number of fragments downloaded concurrently")
     args = parser.parse_args()
 
     assert os.path.exists(args.har_path), f"{args.har_path} not found."
-    assert not any(char in args.output for char in ".,=+()?'|*&^%$#@!`"), f"invalid characters in {args.output}"
+    assert args.n_workers > 0, f"--workers must be positive, got {args.n_workers}."
 
     if args.output == "":
         output_path = os.path.basename(args.har_path).rstrip(".har")
     else:
         output_path = args.output
 
-    output_name = os.path.basename(output_path)
-    video_path = os.path.join(output_path, f"{output_name}.mp4")
-    if os.path.exists(video_path):
-        choice = safe_user_choice(f"'{video_path}' already exists. Overwrite?", "y", "n")
+    paths = Paths.from_output(output_path)
+    if os.path.exists(paths.video):
+        choice = safe_user_choice(f"'{paths.video}' already exists. Overwrite?", "y", "n")
         if choice != "y":
             print("Overwrite not chosen. Ending script.")
             sys.exit()
-        os.remove(video_path)
+        os.remove(paths.video)
 
-    return args.har_path, output_path
+    return args.har_path, paths, args.n_workers
 
 
 def main():
     """"""
-    har_path, output_path = get_inputs()
+    har_path, paths, n_workers = get_inputs()
 
-    print(f"Retrieving {os.path.basename(output_path)}:")
+    print(f"Retrieving {paths.name}:")
     video_links = get_video_links_from_har(har_path)
-    audio_file_paths, video_file_paths = download_video_fragments(video_links, output_path)
-    fragment_concat(output_path, video_file_paths, audio_file_paths)
+    download_and_mux(video_links, paths, n_workers)
+    clean_up_fragments(paths)
 
 
 if __name__ == '__main__':